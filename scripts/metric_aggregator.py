@@ -1,12 +1,19 @@
-import copy
 import csv
 import datetime
 import json
 import logging
+import mmap
 import os
+import re
+import shutil
 import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from operator import itemgetter
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple
 
 from localstack.aws.handlers.metric_handler import Metric
 from localstack.services.plugins import SERVICE_PLUGINS
@@ -17,54 +24,78 @@ template_implemented_item = "- [X] "
 template_not_implemented_item = "- [ ] "
 
 
-def _generate_details_block(details_title: str, details: dict) -> str:
-    output = f"  <details><summary>{details_title}</summary>\n\n"
+def _write_details_block(fd: TextIO, details_title: str, details: dict):
+    fd.write(f"  <details><summary>{details_title}</summary>\n\n")
     for e, count in details.items():
         if count > 0:
-            output += f"  {template_implemented_item}{e}\n"
+            fd.write(f"  {template_implemented_item}{e}\n")
         else:
-            output += f"  {template_not_implemented_item}{e}\n"
-    output += "  </details>\n"
-    return output
+            fd.write(f"  {template_not_implemented_item}{e}\n")
+    fd.write("  </details>\n")
+
+
+def _with_known_names(names: tuple, counts: dict) -> dict:
+    """Returns the counts for all known names (0 if never hit), followed by any additional hits"""
+    result = dict.fromkeys(names, 0)
+    result.update(counts)
+    return result
 
 
 def create_readable_report(file_name: str, metrics: dict):
-    output = "# Metric Collection Report of Integration Tests #\n\n"
-    output += "**__Disclaimer__**: naive calculation of test coverage - if operation is called at least once, it is considered as 'covered'.\n"
-    for service in sorted(metrics.keys()):
-        output += f"## {service} ##\n"
-        details = metrics[service]
-        if not details["service_attributes"]["pro"]:
-            output += "community\n"
-        elif not details["service_attributes"]["community"]:
-            output += "pro only\n"
-        else:
-            output += "community, and pro features\n"
-        del metrics[service]["service_attributes"]
-
-        operation_counter = len(details)
-        operation_tested = 0
-
-        tmp = ""
-        for operation in sorted(details.keys()):
-            op_details = details[operation]
-            if op_details.get("invoked", 0) > 0:
-                operation_tested += 1
-                tmp += f"{template_implemented_item}{operation}\n"
+    with open(file_name, "w", buffering=1 << 20) as fd:
+        fd.write("# Metric Collection Report of Integration Tests #\n\n")
+        fd.write(
+            "**__Disclaimer__**: naive calculation of test coverage - if operation is called at least once, it is considered as 'covered'.\n"
+        )
+        for service in sorted(metrics.keys()):
+            fd.write(f"## {service} ##\n")
+            details = metrics[service]
+            service_attributes = details["service_attributes"]
+            if not service_attributes["pro"]:
+                fd.write("community\n")
+            elif not service_attributes["community"]:
+                fd.write("pro only\n")
             else:
-                tmp += f"{template_not_implemented_item}{operation}\n"
-            if op_details.get("parameters"):
-                parameters = op_details.get("parameters")
+                fd.write("community, and pro features\n")
+
+            operations = sorted(k for k in details if k != "service_attributes")
+            operation_counter = len(operations)
+            # the coverage is part of the summary, and is therefore calculated before the operations are written
+            operation_tested = sum(
+                1 for operation in operations if details[operation].get("invoked", 0) > 0
+            )
+            fd.write(
+                f"<details><summary>{operation_tested/operation_counter*100:.2f}% test coverage</summary>\n\n"
+            )
+
+            for operation in operations:
+                op_details = details[operation]
+                if op_details.get("invoked", 0) > 0:
+                    fd.write(f"{template_implemented_item}{operation}\n")
+                else:
+                    fd.write(f"{template_not_implemented_item}{operation}\n")
+                parameters = _with_known_names(
+                    op_details.get("_parameter_names", ()), op_details.get("parameters", {})
+                )
                 if parameters:
-                    tmp += _generate_details_block("parameters  hit", parameters)
-            if op_details.get("errors"):
-                tmp += _generate_details_block("errors hit", op_details["errors"])
+                    _write_details_block(fd, "parameters  hit", parameters)
+                errors = _with_known_names(
+                    op_details.get("_error_names", ()), op_details.get("errors", {})
+                )
+                if errors:
+                    _write_details_block(fd, "errors hit", errors)
+
+            fd.write("\n</details>\n\n")
 
-        output += f"<details><summary>{operation_tested/operation_counter*100:.2f}% test coverage</summary>\n\n{tmp}\n</details>\n"
 
-        with open(file_name, "a") as fd:
-            fd.write(f"{output}\n")
-            output = ""
+def _compile_error_regex(error_names: tuple) -> Optional[re.Pattern]:
+    """
+    Compiles a single pattern matching any of the given error names, which is used to guess the error from the
+    response data. Longer names are preferred over names which are a prefix of them.
+    """
+    if not error_names:
+        return None
+    return re.compile("|".join(re.escape(e) for e in sorted(error_names, key=len, reverse=True)))
 
 
 def _init_service_metric_counter() -> Dict:
@@ -78,18 +109,20 @@ def _init_service_metric_counter() -> Dict:
             service_attributes = {"pro": "pro" in provider, "community": "default" in provider}
             ops["service_attributes"] = service_attributes
             for op in service.operation_names:
+                model = service.operation_model(op)
                 attributes = {}
                 attributes["invoked"] = 0
-                if hasattr(service.operation_model(op).input_shape, "members"):
-                    params = {}
-                    for n in service.operation_model(op).input_shape.members:
-                        params[n] = 0
-                    attributes["parameters"] = params
-                if hasattr(service.operation_model(op), "error_shapes"):
-                    exceptions = {}
-                    for e in service.operation_model(op).error_shapes:
-                        exceptions[e.name] = 0
-                    attributes["errors"] = exceptions
+                attributes["tests"] = set()
+                attributes["parameters"] = Counter()
+                attributes["errors"] = Counter()
+                # only the names of the known parameters/errors are stored, counters are created on demand
+                attributes["_parameter_names"] = tuple(
+                    getattr(model.input_shape, "members", None) or ()
+                )
+                attributes["_error_names"] = tuple(
+                    e.name for e in getattr(model, "error_shapes", None) or ()
+                )
+                attributes["_error_regex"] = _compile_error_regex(attributes["_error_names"])
                 ops[op] = attributes
 
             metric_recorder[s] = ops
@@ -103,9 +136,23 @@ def print_usage():
     print("usage: python metric_aggregator.py <dir-to-raw-csv-metric> [amd64|arch64]")
 
 
+def _strip_internal_attributes(metric_dict: dict) -> dict:
+    """Removes the internal (underscore-prefixed) attributes of the operations"""
+    return {
+        service: {
+            op: {k: v for k, v in attributes.items() if not k.startswith("_")}
+            for op, attributes in ops.items()
+        }
+        for service, ops in metric_dict.items()
+    }
+
+
 def write_json(file_name: str, metric_dict: dict):
-    with open(file_name, "w") as fd:
-        fd.write(json.dumps(metric_dict, indent=2, sort_keys=True))
+    with open(file_name, "w", buffering=1 << 20) as fd:
+        # the recorded tests are kept in sets, which are serialized as sorted lists
+        json.dump(
+            _strip_internal_attributes(metric_dict), fd, indent=2, sort_keys=True, default=sorted
+        )
 
 
 def _print_diff(metric_recorder_internal, metric_recorder_external):
@@ -116,69 +163,204 @@ def _print_diff(metric_recorder_internal, metric_recorder_external):
                     print(f"found invocation mismatch: {key}.{subkey}")
 
 
-def append_row_to_raw_collection(collection_raw_csv_file_name, row, arch):
-    with open(collection_raw_csv_file_name, "a") as fd:
-        writer = csv.writer(fd)
-        row.append(arch)
-        writer.writerow(row)
+# positions of the fields in the rows of the raw data files, the Metric is not constructed for performance reasons
+_RAW_DATA_INDEX = {name: i for i, name in enumerate(Metric.RAW_DATA_HEADER)}
+_get_raw_data_fields = itemgetter(
+    _RAW_DATA_INDEX["service"],
+    _RAW_DATA_INDEX["operation"],
+    _RAW_DATA_INDEX["parameters"],
+    _RAW_DATA_INDEX["exception"],
+    _RAW_DATA_INDEX["response_code"],
+    _RAW_DATA_INDEX["response_data"],
+    _RAW_DATA_INDEX["test_node_id"],
+    _RAW_DATA_INDEX["xfail"],
+)
+
+
+def _record_invocations(recorded: dict, invocations: Counter):
+    """
+    Adds the grouped invocations to the recorded metrics. The invocations are keyed by
+    (service, operation, parameters, exception, response_code, response_data, node_id), where the response is only
+    set for errors which were not raised as exception, as it is only used to guess the error.
+    """
+    for key, count in invocations.items():
+        service, operation, parameters, exception, response_code, response_data, node_id = key
+        ops = recorded[service][operation]
+
+        errors = ops["errors"]
+        if exception:
+            errors[exception] += count
+        elif response_data and ops["_error_regex"]:
+            match = ops["_error_regex"].search(response_data)
+            if match:
+                # assume we have a match
+                errors[match.group(0)] += count
+                LOG.warning(f"Exception assumed for {service}.{operation}: code {response_code}")
+
+        ops["invoked"] += count
+        params = ops["parameters"]
+        if not parameters:
+            params["_none_"] += count
+        elif count == 1:
+            # counting an iterable is done in C by the Counter
+            params.update(parameters.split(","))
+        else:
+            # the parameter names of a single request are unique
+            params.update(dict.fromkeys(parameters.split(","), count))
+
+        ops["tests"].add(node_id)
+
+
+# size of the buffer for the collected records, which is written to the collection file once it is full
+_COLLECTION_BUFFER_SIZE = 1 << 20
+
+
+def _write_all(fd: int, data: bytearray):
+    """Writes all the data to the file descriptor, a single os.write might only write a part of it"""
+    written = os.write(fd, data)
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+
+def _iter_raw_records(path: str) -> Iterator[bytes]:
+    """
+    Yields the records of a raw data file (without line terminator), by scanning a memory map of the file.
+    A line break only ends a record if it is not within a quoted field, i.e., if the record contains an even number of
+    quotes up to this point.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if not os.fstat(fd).st_size:
+            return
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            start = pos = 0
+            quotes = 0
+            while pos < size:
+                end = mm.find(b"\n", pos)
+                if end < 0:
+                    end = size
+                line = mm[pos:end]
+                quotes += line.count(b'"')
+                if quotes % 2 == 0:
+                    record = line if start == pos else mm[start:end]
+                    if record.endswith(b"\r"):
+                        record = record[:-1]
+                    if record:
+                        yield record
+                    start = end + 1
+                    quotes = 0
+                pos = end + 1
+    finally:
+        os.close(fd)
+
+
+def _parse_raw_record(record: bytes) -> List[str]:
+    """Splits a record into its fields, the csv module is only needed for records with quoted fields"""
+    line = record.decode("utf-8")
+    if '"' not in line:
+        return line.split(",")
+    return next(csv.reader((line,)))
+
+
+def aggregate_one(
+    path: Path, collect_for_arch: Optional[str] = "", collection_dir: Optional[str] = None
+) -> Tuple[Counter, Optional[str]]:
+    """
+    Aggregates a single raw data file, and returns the grouped invocations (see _record_invocations).
+    If collection_dir is set, the rows of the file are additionally copied into a new file in this directory,
+    extended by the arch. The name of this file is returned as well.
+    """
+    invocations = Counter()
+    path_str = os.fspath(path)
+    # the arch only depends on the path, so it is determined once per file
+    arch = "arm64" if "arm64" in path_str else ("amd64" if "amd64" in path_str else "")
+    skip_file = bool(collect_for_arch) and collect_for_arch not in path_str
+    if skip_file and not collection_dir:
+        return invocations, None
+    print(f"checking {path_str}")
+
+    collection_file = None
+    collection_fd = None
+    arch_suffix = f",{arch}\r\n".encode("utf-8")
+    if collection_dir:
+        collection_fd, collection_file = tempfile.mkstemp(suffix=".csv", dir=collection_dir)
+    buffer = bytearray()
+    try:
+        records = _iter_raw_records(path_str)
+        # skip the header
+        next(records, None)
+        for record in records:
+            if collection_fd is not None:
+                # the record is already valid csv, it is copied as is
+                buffer += record
+                buffer += arch_suffix
+                if len(buffer) >= _COLLECTION_BUFFER_SIZE:
+                    _write_all(collection_fd, buffer)
+                    buffer.clear()
+            if skip_file:
+                # the file is only collected, but not aggregated
+                continue
+
+            (
+                service,
+                operation,
+                parameters,
+                exception,
+                response_code,
+                response_data,
+                node_id,
+                xfail,
+            ) = _get_raw_data_fields(_parse_raw_record(record))
+            if xfail == "True":
+                print(f"test {node_id} marked as xfail")
+                continue
+
+            if exception or int(response_code) < 300:
+                response_code = response_data = ""
+            # identical invocations are grouped, and only accounted once per group
+            invocations[
+                (service, operation, parameters, exception, response_code, response_data, node_id)
+            ] += 1
+
+        if buffer:
+            _write_all(collection_fd, buffer)
+    finally:
+        if collection_fd is not None:
+            os.close(collection_fd)
+
+    return invocations, collection_file
 
 
 def aggregate_recorded_raw_data(
     base_dir: str, collection_raw_csv: Optional[str] = None, collect_for_arch: Optional[str] = ""
 ) -> dict:
-    pathlist = Path(base_dir).rglob("metric-report-raw-data-*.csv")
+    # sorted, so that the raw collection is deterministic
+    pathlist = sorted(Path(base_dir).rglob("metric-report-raw-data-*.csv"))
     recorded = _init_service_metric_counter()
-    for path in pathlist:
-        print(f"checking {str(path)}")
-        with open(path, "r") as csv_obj:
-            csv_dict_reader = csv.reader(csv_obj)
-            # skip the header
-            next(csv_dict_reader)
-            for row in csv_dict_reader:
-                if collection_raw_csv:
-                    arch = ""
-                    if "arm64" in str(path):
-                        arch = "arm64"
-                    elif "amd64" in str(path):
-                        arch = "amd64"
-                    append_row_to_raw_collection(collection_raw_csv, copy.deepcopy(row), arch)
-
-                metric: Metric = Metric(*row)
-                if metric.xfail == "True":
-                    print(f"test {metric.node_id} marked as xfail")
-                    continue
-                if collect_for_arch and collect_for_arch not in str(path):
-                    continue
-
-                service = recorded[metric.service]
-                ops = service[metric.operation]
-
-                errors = ops.setdefault("errors", {})
-                if metric.exception:
-                    exception = metric.exception
-                    errors[exception] = ops.get(exception, 0) + 1
-                elif int(metric.response_code) >= 300:
-                    for expected_error in ops.get("errors", {}).keys():
-                        if expected_error in metric.response_data:
-                            # assume we have a match
-                            errors[expected_error] += 1
-                            LOG.warning(
-                                f"Exception assumed for {metric.service}.{metric.operation}: code {metric.response_code}"
-                            )
-                            break
-
-                ops["invoked"] += 1
-                if not metric.parameters:
-                    params = ops.setdefault("parameters", {})
-                    params["_none_"] = params.get("_none_", 0) + 1
-                else:
-                    for p in metric.parameters.split(","):
-                        ops["parameters"][p] += 1
-
-                test_list = ops.setdefault("tests", [])
-                if metric.node_id not in test_list:
-                    test_list.append(metric.node_id)
-
+    invocations = Counter()
+    with tempfile.TemporaryDirectory() as collection_dir, ProcessPoolExecutor() as executor:
+        # the files are independent of each other, and aggregated in parallel
+        results = executor.map(
+            aggregate_one,
+            pathlist,
+            repeat(collect_for_arch),
+            repeat(collection_dir if collection_raw_csv else None),
+        )
+        # keep the collection file open for the whole aggregation, and append the collected rows of each file
+        collection_fd = open(collection_raw_csv, "ab") if collection_raw_csv else None
+        try:
+            for file_invocations, collection_file in results:
+                invocations.update(file_invocations)
+                if collection_file:
+                    with open(collection_file, "rb") as fd:
+                        shutil.copyfileobj(fd, collection_fd, 1 << 20)
+                    os.remove(collection_file)
+        finally:
+            if collection_fd:
+                collection_fd.close()
+
+    _record_invocations(recorded, invocations)
     return recorded
 
 
@@ -202,7 +384,7 @@ def main():
 
     metrics_path = os.path.join(base_dir, "metrics")
     Path(metrics_path).mkdir(parents=True, exist_ok=True)
-    dtime = datetime.datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%s")
+    dtime = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d-%H-%M-%S")
 
     collection_raw_csv = os.path.join(metrics_path, f"raw-collected-data-{dtime}.csv")
 